@@ -1,14 +1,52 @@
-import argparse
 import csv
+import io
+import mmap
 import os
 import random
+import re
 import sys
 import warnings
 
-from datetime import datetime, timedelta
+from collections import namedtuple
+from functools import partial
 
+# Consecutive data points stored column by column, as parallel lists of
+# tickers, dates and prices. Any columns after the price are kept, per row, in
+# extras so they are written back unchanged.
+Window = namedtuple('Window', ['tickers', 'dates', 'prices', 'extras'])
+
+# Parsed dates keyed by their raw 'DD-MM-YYYY' string. Files of the same
+# exchange usually cover the same days, so each distinct string is only
+# checked and converted once.
+_date_cache = {}
+
+# Field formats checked by check_data_sanity. These are intentionally
+# stricter or looser than the old isalpha/strptime/float checks in a few
+# cases: tickers must be ASCII letters, years only need 4 digits (e.g. 0999)
+# and prices can't be inf or nan. Only ASCII digits are accepted, and prices
+# have at most 13 integer digits, so all 15 significant digits survive the
+# conversion to float.
+_TICKER_RE = re.compile(r'[A-Za-z]+')
+_DATE_RE = re.compile(r'([0-9]{2})-([0-9]{2})-([0-9]{4})')
+_PRICE_RE = re.compile(r'-?(?:0|[1-9][0-9]{0,12})\.[0-9]{2}')
+
+# Size of the blocks in which memory mapped files are scanned for new lines.
+_CHUNK_SIZE = 1 << 16
+
+# Buffer size used when a whole .csv file is read through csv.reader.
+_READ_BUFFER_SIZE = 1 << 20
+
+_DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+# Argument parser built on the first call of parse_arguments.
+_parser = None
+
+
+def _build_parser():
+    # Only imported when arguments are actually parsed, as it is not needed
+    # for the processing itself.
+    import argparse
 
-def parse_arguments(args):
     parser = argparse.ArgumentParser(
         description='Read market data and predict the next three data '
         'points for each ticker.\n'
@@ -48,7 +86,62 @@ def parse_arguments(args):
                         'List of directories to look into for .csv files.',
                         dest='dirs')
 
-    return parser.parse_args(args)
+    return parser
+
+
+def parse_arguments(args):
+    global _parser
+    # Build the parser only once, in case main is called multiple times.
+    if _parser is None:
+        _parser = _build_parser()
+    return _parser.parse_args(args)
+
+
+def _parse_date(date_string):
+    """
+    Parse a 'DD-MM-YYYY' string into a (day, month, year) tuple of integers,
+    reusing earlier results. Returns None if the string is not a valid date.
+    """
+    date = _date_cache.get(date_string)
+    if date is None:
+        date_match = _DATE_RE.fullmatch(date_string)
+        if not date_match:
+            return None
+        day, month, year = map(int, date_match.groups())
+        if (year < 1 or not 1 <= month <= 12 or
+                not 1 <= day <= _days_in_month(year, month)):
+            return None
+        date = (day, month, year)
+        _date_cache[date_string] = date
+    return date
+
+
+def _parse_unchecked_date(date_string):
+    """
+    Parse a 'D-M-YYYY' string, with or without zero padding, into a (day,
+    month, year) tuple of integers. Used for data that skipped the sanity
+    check, so it is as lenient as strptime was. Raises ValueError if the
+    string is not a valid date.
+    """
+    try:
+        day, month, year = map(int, date_string.split('-'))
+    except ValueError:
+        raise ValueError('Invalid date {}! Check input files'
+                         .format(date_string)) from None
+    if (year < 1 or not 1 <= month <= 12 or
+            not 1 <= day <= _days_in_month(year, month)):
+        raise ValueError('Invalid date {}! Check input files'
+                         .format(date_string))
+    return day, month, year
+
+
+def _days_in_month(year, month):
+    """
+    Number of days in the given month, accounting for leap years.
+    """
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        return 29
+    return _DAYS_IN_MONTH[month - 1]
 
 
 def get_files(dirs, files_number):
@@ -60,15 +153,18 @@ def get_files(dirs, files_number):
     files = []
     for dir in dirs:
         file_count = 0
-        for file in os.listdir(dir):
-            # Don't go over the imposed file limit. While the limit is defined
-            # to be either 1 or 2, the code supports setting any limit.
-            if file_count >= files_number:
-                continue
-            if file.endswith('.csv'):
-                file_count += 1  # Count only .csv files
-                file_path = os.path.join(dir, file)
-                files.append(file_path)
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                # Don't go over the imposed file limit. While the limit is
+                # defined to be either 1 or 2, the code supports setting any
+                # limit.
+                if file_count >= files_number:
+                    break
+                # The entry type is usually known from the directory listing,
+                # so is_file() rarely needs an extra stat call.
+                if entry.name.endswith('.csv') and entry.is_file():
+                    file_count += 1  # Count only .csv files
+                    files.append(entry.path)
         if file_count < files_number:
             warnings.warn('Found only {} .csv files in directory {} but the '
                           'recommended number to read from is {}.'
@@ -79,28 +175,87 @@ def get_files(dirs, files_number):
 
 def check_data_sanity(rows):
     """
-    Reads a list of lists and tests that each individual list is in format
-    "STRING,DD-MM-YYYY,2-decimal float". It also checks if the main list should
-    never have less than 10 items.
+    Reads an iterable of lists and tests that each individual list is in
+    format "STRING,DD-MM-YYYY,2-decimal float". It also checks that there are
+    never less than 10 items. Rows are consumed one at a time, so a csv reader
+    can be passed directly without loading the whole file.
+    Returns the date of the last row as a (day, month, year) tuple if the data
+    is correct, so it doesn't have to be parsed again, or False if not.
     """
-    if len(rows) < 10:
-        return False
-
-    for row in rows:
-        if not row[0].isalpha():
+    row_count = 0
+    for row_count, row in enumerate(rows, 1):
+        if not _TICKER_RE.fullmatch(row[0]):
             return False
-        try:
-            if row[1] != datetime.strptime(row[1],
-                                           '%d-%m-%Y').strftime('%d-%m-%Y'):
-                raise ValueError
-        except ValueError:
+        date = _parse_date(row[1])
+        if date is None:
             return False
-        try:
-            if row[2] != '{:.2f}'.format(float(row[2])):
-                raise ValueError
-        except ValueError:
+        if not _PRICE_RE.fullmatch(row[2]):
             return False
-    return True
+    if row_count < 10:
+        return False
+    return date
+
+
+def _line_terminator(mapped):
+    """
+    Get the byte that ends the lines of a memory mapped file. This is b'\n'
+    for both '\n' and '\r\n' line endings, or b'\r' for files that only use
+    old Mac style '\r' line endings, which open() also accepts.
+    """
+    if mapped.find(b'\n') == -1 and mapped.find(b'\r') != -1:
+        return b'\r'
+    return b'\n'
+
+
+def _count_rows(mapped, newline):
+    """
+    Count the lines of a memory mapped file by counting new lines in large
+    chunks, without decoding or splitting it.
+    """
+    row_count = sum(mapped[offset:offset + _CHUNK_SIZE].count(newline)
+                    for offset in range(0, len(mapped), _CHUNK_SIZE))
+    # The last line may not be terminated by a new line.
+    if len(mapped) and mapped[-1:] != newline:
+        row_count += 1
+    return row_count
+
+
+def _row_offset(mapped, newline, row_count, offset=0):
+    """
+    Get the byte offset of the line found row_count lines after the given
+    offset of a memory mapped file, or the end of the file if there are not
+    that many lines.
+    """
+    # Skip whole chunks while they have fewer new lines than needed, so only
+    # the last chunk is searched one line at a time.
+    while offset < len(mapped):
+        chunk_rows = mapped[offset:offset + _CHUNK_SIZE].count(newline)
+        if chunk_rows >= row_count:
+            break
+        row_count -= chunk_rows
+        offset += _CHUNK_SIZE
+    else:
+        return len(mapped)
+
+    for _ in range(row_count):
+        offset = mapped.find(newline, offset) + 1
+    return offset
+
+
+def _sample_rows(mapped):
+    """
+    Get 10 consecutive lines from a random starting point of a memory mapped
+    file. Returns them as bytes or None if the file has less than 10 lines.
+    """
+    newline = _line_terminator(mapped)
+    row_count = _count_rows(mapped, newline)
+    if row_count < 10:
+        return None
+    # Get a random starting point with at least 10 rows to spare.
+    random_index = random.randrange(row_count - 9)
+    start = _row_offset(mapped, newline, random_index)
+    end = _row_offset(mapped, newline, 10, start)
+    return mapped[start:end]
 
 
 def extract_values(file, data_check):
@@ -108,58 +263,72 @@ def extract_values(file, data_check):
     Get a .csv file and extract 10 consecutive rows from a random starting
     point. Checks if the file or sequence of 10 has the correct format. This
     is controlled by the --data-sanity-check option.
-    Returns a list of 10 rows if the format is correct or False if not.
+    Returns a Window of 10 data points together with the date of the last one
+    if the format is correct or False if not. The date is None unless it was
+    already parsed while checking the sequence.
     """
-    with open(file) as csv_file:
-        csv_reader = csv.reader(csv_file)
-        rows = list(csv_reader)
-
     if data_check == 'file':
-        if not check_data_sanity(rows):
-            warnings.warn('File {} has corrupted data.'.format(file))
-            return False
-
-    # Get a random number but make sure we have at least 10 rows to spare.
-    try:
-        random_index = random.randint(0, (len(rows) - 10))
-    except ValueError:
+        # Validate while reading so that the rows are never all kept in memory.
+        # A bigger buffer than the default needs fewer reads for big files.
+        with open(file, buffering=_READ_BUFFER_SIZE,
+                  newline='') as csv_file:
+            if not check_data_sanity(csv.reader(csv_file)):
+                warnings.warn('File {} has corrupted data.'.format(file))
+                return False
+
+    with open(file, 'rb') as binary_file:
+        # Empty files can't be memory mapped, but they have no rows anyway.
+        if os.fstat(binary_file.fileno()).st_size:
+            with mmap.mmap(binary_file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                sampled_rows = _sample_rows(mapped)
+        else:
+            sampled_rows = None
+    if sampled_rows is None:
         # We should not get here if the file was checked for correct data.
-        warnings.warn('File {} has corrupted data. Consider checking the file '
-                      'for data sanity'.format(file))
+        if data_check == 'file':
+            warnings.warn('File {} has corrupted data.'.format(file))
+        else:
+            warnings.warn('File {} has corrupted data. Consider checking the '
+                          'file for data sanity'.format(file))
         return False
-    ten_values = []
-    for i in range(10):
-        # Start from the random position and save the next 10 rows.
-        ten_values.append(rows[random_index + i])
+    # Only the sampled rows are decoded and parsed. Rows are split by the csv
+    # reader itself, on the same new lines used to locate them, and decoded
+    # with the same default encoding used by open() for the file check.
+    sampled_file = io.TextIOWrapper(io.BytesIO(sampled_rows), newline='')
+    ten_values = list(csv.reader(sampled_file))
 
+    last_date = None
     if data_check == 'sequence':
-        if not check_data_sanity(ten_values):
+        last_date = check_data_sanity(ten_values)
+        if not last_date:
             warnings.warn('File {} has corrupted data.'.format(file))
             return False
 
-    return ten_values
+    # Store the columns separately, as each is used on its own afterwards.
+    window = Window(tickers=[row[0] for row in ten_values],
+                    dates=[row[1] for row in ten_values],
+                    prices=[row[2] for row in ten_values],
+                    extras=[row[3:] for row in ten_values])
+    return window, last_date
 
 
-def predict_values(values):
+def _predict_prices(prices):
     """
-    Gets a list of 10 rows with and returns the next 3 predictions according
-    to the given algorithm, in the same format.
+    Numeric part of the prediction. Gets the 10 prices as floats and returns
+    the next 3 predicted prices as floats.
     """
     highest = 0  # I assume these can't have negative prices.
+    second_highest = 0
 
-    # Get the highest value.
-    for value in values:
-        price = float(value[2])  # Convert from string.
+    # Get the highest and second highest values in a single pass.
+    for price in prices:
         if price > highest:
+            second_highest = highest
             highest = price
-
-    second_highest = 0
-    # Get the second highest value.
-    for value in values:
-        price = float(value[2])  # Convert from string.
         # There could be multiple lines with the highest value, so we skip
         # all of them.
-        if price > second_highest and price != highest:
+        elif price < highest and price > second_highest:
             second_highest = price
 
     if second_highest == 0:
@@ -173,7 +342,7 @@ def predict_values(values):
     # I assume "n+2 data point has half the difference between n and n+1"
     # actually means n+2 is the average of n and n+1, as that makes sense. What
     # this sentence is telling me is that n+2 is abs(n - n+1).
-    second_prediction = (float(values[-1][2]) + first_prediction) / 2
+    second_prediction = (prices[-1] + first_prediction) / 2
 
     # I assume "n+3 data point has 1/4th the difference between n+1 and n+2"
     # means n+3 is bigger(or smaller) than n+2 by a quarter of the absolute
@@ -186,26 +355,74 @@ def predict_values(values):
         third_prediction = (second_prediction +
                             (first_prediction - second_prediction) / 4)
 
-    # Convert back to the expected format.
-    predictions = ['{:.2f}'.format(first_prediction),
-                   '{:.2f}'.format(second_prediction),
-                   '{:.2f}'.format(third_prediction)]
+    return first_prediction, second_prediction, third_prediction
 
-    # Get the last item's date
-    date = datetime.strptime(values[-1][1], '%d-%m-%Y')
-    predicted_rows = []
-    for index in range(3):
-        row = []
-        row.append(values[0][0])  # Ticker is the same.
 
-        # Many date exemptions and edge-cases solved by timedelta.
-        date += timedelta(days=1)
-        row.append(date.strftime('%d-%m-%Y'))
+def predict_values(window, last_date=None):
+    """
+    Gets a Window of 10 data points and returns the next 3 predictions
+    according to the given algorithm, in the same format. The date of the last
+    data point can be passed in if it was already parsed.
+    """
+    # Convert every price from string only once.
+    prices = [float(price) for price in window.prices]
+    first_prediction, second_prediction, third_prediction = (
+        _predict_prices(prices))
 
-        row.append(predictions[index])
-        predicted_rows.append(row)
+    # Convert back to the expected format.
+    format_price = '{:.2f}'.format
+    predictions = [format_price(first_prediction),
+                   format_price(second_prediction),
+                   format_price(third_prediction)]
 
-    return predicted_rows
+    # Get the last item's date
+    if last_date is None:
+        last_date = _parse_unchecked_date(window.dates[-1])
+    day, month, year = last_date
+    dates = []
+    for _ in predictions:
+        # Move to the next day, rolling over the end of the month and year.
+        # Only three days are needed, so plain integers are enough.
+        day += 1
+        if day > _days_in_month(year, month):
+            day = 1
+            month += 1
+            if month > 12:
+                month = 1
+                year += 1
+        dates.append('{:02d}-{:02d}-{:04d}'.format(day, month, year))
+
+    # Ticker is the same.
+    return Window(tickers=[window.tickers[0]] * 3, dates=dates,
+                  prices=predictions, extras=[[], [], []])
+
+
+def _process_file(file, data_check):
+    """
+    Extract the values of a single .csv file, predict the next ones and write
+    them all under the 'predictions' folder. The output directory is expected
+    to exist already.
+    """
+    extracted = extract_values(file, data_check)
+    if extracted:  # it passed the data sanity
+        window, last_date = extracted
+        predicted = predict_values(window, last_date)
+        final_values = ([ticker, date, price] + extras
+                        for ticker, date, price, extras in zip(
+                            window.tickers + predicted.tickers,
+                            window.dates + predicted.dates,
+                            window.prices + predicted.prices,
+                            window.extras + predicted.extras))
+
+        output_file_path = 'predictions/{}'.format(file)
+
+        # Format the whole file in memory and write it with a single call.
+        # csv.writer still does the formatting, so fields with commas or
+        # quotes are quoted even when the data wasn't checked.
+        output_buffer = io.StringIO(newline='')
+        csv.writer(output_buffer).writerows(final_values)
+        with open(output_file_path, 'w', newline='') as output_csv_file:
+            output_csv_file.write(output_buffer.getvalue())
 
 
 def main(args):
@@ -217,22 +434,36 @@ def main(args):
         # All directories in current working directory.
         dirs = filter(os.path.isdir, os.listdir(os.getcwd()))
 
-    files = get_files(dirs, parsed_args.files_number)
-
-    for file in files:
-        values = extract_values(file, parsed_args.data_check)
-        if values:  # it passed the data sanity
-            predicted_values = predict_values(values)
-            final_values = values + predicted_values
-
-            output_file_path = 'predictions/{}'.format(file)
-            # Make a 'predictions' folder contains the same structure as the
-            # input folders.
-            os.makedirs(os.path.split(output_file_path)[0], exist_ok=True)
-
-            with open(output_file_path, 'w') as output_csv_file:
-                csv_writer = csv.writer(output_csv_file)
-                csv_writer.writerows(final_values)
+    # The same directory may be given more than once, but each file only
+    # needs to be processed once as it always has the same output file.
+    files = list(dict.fromkeys(
+        map(os.path.normpath, get_files(dirs, parsed_args.files_number))))
+    # Start with the biggest files so that no worker is left processing a big
+    # file at the end while the others are idle.
+    files.sort(key=os.path.getsize, reverse=True)
+
+    # Make a 'predictions' folder contains the same structure as the input
+    # folders. There are only a few distinct ones, so create each just once.
+    output_dirs = {os.path.dirname('predictions/{}'.format(file))
+                   for file in files}
+    for output_dir in output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+
+    process_file = partial(_process_file, data_check=parsed_args.data_check)
+    max_workers = min(len(files), os.cpu_count() or 1)
+    if max_workers <= 1:
+        # Starting worker processes would cost more than the work itself.
+        for file in files:
+            process_file(file)
+    else:
+        # Only imported when needed, as the import alone takes a while.
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Each file is processed independently, so spread them over all
+        # cores. Files are handed out one at a time to keep the biggest-first
+        # order.
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(process_file, files))
 
     # write_file(extracted_values, predicted_values)
 